@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+import requests
+from hyp3_sdk import HyP3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+BACKOFF_FACTOR = 1
+# Re-authenticate when the HyP3 session cookie is this close to expiring
+AUTH_EXPIRATION_MARGIN = timedelta(minutes=5)
+
+SESSIONS: dict[str, requests.Session] = {}
+HYP3_CLIENTS: dict[tuple, HyP3] = {}
+CLIENTS_LOCK = Lock()
+HYP3_LOGINS = 0
+
+
+def mount_adapter(session: requests.Session, pool_maxsize: int, allowed_methods=Retry.DEFAULT_ALLOWED_METHODS):
+    # Callers still see the final response of a failed retry sequence, so existing status code handling is unchanged
+    retry = Retry(
+        total=3,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=allowed_methods,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def get_session(name: str, pool_maxsize: int = 10, retry_post: bool = False) -> requests.Session:
+    with CLIENTS_LOCK:
+        if name not in SESSIONS:
+            session = requests.Session()
+            allowed_methods = Retry.DEFAULT_ALLOWED_METHODS | {'POST'} if retry_post else Retry.DEFAULT_ALLOWED_METHODS
+            mount_adapter(session, pool_maxsize, allowed_methods)
+            SESSIONS[name] = session
+        return SESSIONS[name]
+
+
+def is_auth_expired(session: requests.Session) -> bool:
+    expires_before = (datetime.now(tz=timezone.utc) + AUTH_EXPIRATION_MARGIN).timestamp()
+    return any(cookie.is_expired(int(expires_before)) for cookie in session.cookies)
+
+
+def get_hyp3(api_url: str, username: str, password: str, pool_maxsize: int = 10) -> HyP3:
+    global HYP3_LOGINS
+    with CLIENTS_LOCK:
+        key = (api_url, username, password)
+        hyp3 = HYP3_CLIENTS.get(key)
+        if hyp3 is None or is_auth_expired(hyp3.session):
+            hyp3 = HyP3(api_url, username=username, password=password)
+            # Job submissions are not idempotent, so only HyP3's idempotent requests are retried
+            mount_adapter(hyp3.session, pool_maxsize)
+            HYP3_CLIENTS[key] = hyp3
+            HYP3_LOGINS += 1
+        return hyp3
+
+
+def get_connection_stats() -> dict:
+    sessions = list(SESSIONS.values()) + [hyp3.session for hyp3 in HYP3_CLIENTS.values()]
+    connections = 0
+    requests_sent = 0
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools[pool_key]
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+    return {
+        'connections': connections,
+        'requests': requests_sent,
+        'reused': requests_sent - connections,
+        'hyp3_logins': HYP3_LOGINS,
+    }
@@ -9,23 +9,28 @@ from boto3.dynamodb.conditions import Attr, Key
 DB = boto3.resource('dynamodb')
 EVENT_TABLE = environ.get('EVENT_TABLE', None)
 PRODUCT_TABLE = environ.get('PRODUCT_TABLE', None)
+STATE_TABLE = environ.get('STATE_TABLE', None)
 
 
-def query_table(table_name, key_expression, filter_expression=None, index_name=None):
-    table = DB.Table(table_name)
+def query_table(table_name, key_expression, filter_expression=None, index_name=None, projection_expression=None):
+    # Query through the thread-safe client rather than a Table resource, since callers query from worker threads
+    client = DB.meta.client
     query_params = {
+        'TableName': table_name,
         'KeyConditionExpression': key_expression,
     }
     if filter_expression:
         query_params['FilterExpression'] = filter_expression
     if index_name:
         query_params['IndexName'] = index_name
+    if projection_expression:
+        query_params['ProjectionExpression'] = projection_expression
 
-    response = table.query(**query_params)
+    response = client.query(**query_params)
     items = response['Items']
 
     while 'LastEvaluatedKey' in response:
-        response = table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_params)
+        response = client.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_params)
         items.extend(response['Items'])
     return items
 
@@ -42,6 +47,10 @@ def get_events() -> List[dict]:
     return events
 
 
+def get_active_events() -> List[dict]:
+    return query_table(EVENT_TABLE, Key('event_status').eq('ACTIVE'), index_name='event_status')
+
+
 def get_event(event_id: str) -> dict:
     table = DB.Table(EVENT_TABLE)
     response = table.get_item(Key={'event_id': event_id})
@@ -52,6 +61,18 @@ def get_event(event_id: str) -> dict:
     return response['Item']
 
 
+def update_event(event_id: str, attributes: dict):
+    names = {f'#a{index}': name for index, name in enumerate(attributes)}
+    values = {f':a{index}': value for index, value in enumerate(attributes.values())}
+    DB.meta.client.update_item(
+        TableName=EVENT_TABLE,
+        Key={'event_id': event_id},
+        UpdateExpression='SET ' + ', '.join(f'{name} = {value}' for name, value in zip(names, values)),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+    )
+
+
 def get_products_for_event(event_id: str, status_code: str | None = None) -> List[dict]:
     key_expression = Key('event_id').eq(event_id)
     if status_code:
@@ -61,6 +82,12 @@ def get_products_for_event(event_id: str, status_code: str | None = None) -> Lis
         return query_table(PRODUCT_TABLE, key_expression)
 
 
+def get_processed_granule_names(event_id: str) -> set[str]:
+    # Read only each product's reference granule name rather than whole products with every granule footprint
+    items = query_table(PRODUCT_TABLE, Key('event_id').eq(event_id), projection_expression='granules[0].granule_name')
+    return {item['granules'][0]['granule_name'] for item in items}
+
+
 def get_products_by_status(status_code: str, processed_since: datetime | None = None) -> List[dict]:
     key_expression = Key('status_code').eq(status_code)
     if processed_since:
@@ -70,5 +97,41 @@ def get_products_by_status(status_code: str, processed_since: datetime | None =
 
 
 def put_product(product: dict):
-    table = DB.Table(PRODUCT_TABLE)
-    table.put_item(Item=product)
+    # Write through the thread-safe client rather than a Table resource, since callers write from worker threads
+    DB.meta.client.put_item(TableName=PRODUCT_TABLE, Item=product)
+
+
+def set_product_file(event_id: str, product_id: str, name: str, url: str):
+    client = DB.meta.client
+    update_params = {
+        'TableName': PRODUCT_TABLE,
+        'Key': {'event_id': event_id, 'product_id': product_id},
+        'ExpressionAttributeNames': {'#name': name},
+        'ExpressionAttributeValues': {':url': url},
+    }
+    try:
+        client.update_item(
+            UpdateExpression='SET files.#name = :url', ConditionExpression='attribute_exists(files)', **update_params
+        )
+    except client.exceptions.ConditionalCheckFailedException:
+        try:
+            client.update_item(
+                TableName=PRODUCT_TABLE,
+                Key=update_params['Key'],
+                UpdateExpression='SET files = :files',
+                ConditionExpression='attribute_not_exists(files)',
+                ExpressionAttributeValues={':files': {name: url}},
+            )
+        except client.exceptions.ConditionalCheckFailedException:
+            client.update_item(UpdateExpression='SET files.#name = :url', **update_params)
+
+
+def get_state(state_id: str) -> dict | None:
+    table = DB.Table(STATE_TABLE)
+    response = table.get_item(Key={'state_id': state_id})
+    return response.get('Item')
+
+
+def put_state(state: dict):
+    table = DB.Table(STATE_TABLE)
+    table.put_item(Item=state)
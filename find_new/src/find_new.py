@@ -1,25 +1,34 @@
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from os import environ
 from typing import List
 from uuid import uuid4
 
 import asf_search
-import requests
 from dateutil import parser
-from hyp3_sdk import HyP3
 from hyp3_sdk.exceptions import HyP3Error, ServerError
 
-from database import database
+from database import clients, database
 
 
 SEARCH_URL = 'https://api.daac.asf.alaska.edu/services/search/param'
+EVENT_CONCURRENCY = int(environ.get('EVENT_CONCURRENCY', 4))
+# Incremental searches reach back this far before the previous search to catch granules ingested late
+SEARCH_OVERLAP = timedelta(hours=int(environ.get('SEARCH_OVERLAP_HOURS', 48)))
+# Events are searched for this long after their processing timeframe ends, then closed
+EVENT_CATCH_UP = timedelta(days=int(environ.get('EVENT_CATCH_UP_DAYS', 14)))
 
 
 class GranuleError(Exception):
     """Raised for granules for which jobs will not succeed"""
 
 
-def get_granules(event):
+def get_search_session():
+    # product_list searches are POSTed but read-only, so they are safe to retry
+    return clients.get_session('search', retry_post=True)
+
+
+def get_granules(event, full_rescan=False):
     search_params = {
         'intersectsWith': event.get('wkt'),
         'start': event['processing_timeframe']['start'],
@@ -29,15 +38,17 @@ def get_granules(event):
         'processingLevel': 'SLC',
         'output': 'jsonlite',
     }
-    response = requests.get(SEARCH_URL, params=search_params)
+    if 'search_watermark' in event and not full_rescan:
+        processed_since = parser.parse(event['search_watermark']) - SEARCH_OVERLAP
+        search_params['processingDate'] = processed_since.isoformat(timespec='seconds')
+    response = get_search_session().get(SEARCH_URL, params=search_params)
     response.raise_for_status()
     return response.json()['results']
 
 
-def get_unprocessed_granules(event):
-    all_granules = get_granules(event)
-    existing_products = database.get_products_for_event(event['event_id'])
-    processed_granule_names = [product['granules'][0]['granule_name'] for product in existing_products]
+def get_unprocessed_granules(event, full_rescan=False):
+    all_granules = get_granules(event, full_rescan)
+    processed_granule_names = database.get_processed_granule_names(event['event_id'])
     return [granule for granule in all_granules if granule['granuleName'] not in processed_granule_names]
 
 
@@ -90,7 +101,9 @@ def get_neighbors(product_name: str, max_neighbors: int = 2) -> List[dict]:
     if len(neighbor_names) == 0:
         neighbors = []
     else:
-        response = requests.post(SEARCH_URL, params={'product_list': ','.join(neighbor_names), 'output': 'jsonlite'})
+        response = get_search_session().post(
+            SEARCH_URL, params={'product_list': ','.join(neighbor_names), 'output': 'jsonlite'}
+        )
 
         status_code = str(response.status_code)
         if status_code[0] == '4':
@@ -122,7 +135,7 @@ def submit_jobs_for_granule(hyp3, event_id, granule):
     except asf_search.ASFSearchError as e:
         print(e)
         print(f'Server error finding neighbors for {granule["granuleName"]}, skipping...')
-        return
+        return False
 
     for neighbor in neighbors:
         insar_job = hyp3.prepare_insar_job(
@@ -138,27 +151,58 @@ def submit_jobs_for_granule(hyp3, event_id, granule):
     except ServerError as e:
         print(e)
         print(f'Server error submitting {granule["granuleName"]} to HyP3, skipping...')
-        return
+        return False
 
     for job, granule_list in zip(submitted_jobs, granule_lists):
         product = format_product(job, event_id, granule_list)
         database.put_product(product)
+    return True
 
 
-def handle_event(hyp3, event):
+def handle_event(hyp3, event, full_rescan=False):
     print(f'processing event: {event["event_id"]}')
-    granules = get_unprocessed_granules(event)
+    search_time = datetime.now(tz=timezone.utc).isoformat(timespec='seconds')
+    granules = get_unprocessed_granules(event, full_rescan)
+    all_granules_recorded = True
     for granule in granules:
         try:
-            submit_jobs_for_granule(hyp3, event['event_id'], granule)
+            if not submit_jobs_for_granule(hyp3, event['event_id'], granule):
+                all_granules_recorded = False
         except GranuleError as e:
             print(e.__context__)
             print(f'Error submitting {granule["granuleName"]} to HyP3, creating FAILED product record')
             add_invalid_product_record(event['event_id'], granule, str(e.__context__))
 
+    # Skipped granules have no product record, so the next search must reach back far enough to find them again
+    if all_granules_recorded:
+        event_status = 'CLOSED' if is_catch_up_complete(event, search_time) else 'ACTIVE'
+        if event_status == 'CLOSED':
+            print(f'closing event: {event["event_id"]}')
+        database.update_event(event['event_id'], {'search_watermark': search_time, 'event_status': event_status})
+
+
+def is_catch_up_complete(event, search_time):
+    end = event['processing_timeframe'].get('end')
+    return end is not None and parser.parse(end) + EVENT_CATCH_UP < parser.parse(search_time)
+
+
+def get_events_to_search(full_rescan):
+    if full_rescan:
+        # Scanning also picks up events registered without an event_status
+        return [event for event in database.get_events() if event.get('event_status') != 'CLOSED']
+    return database.get_active_events()
+
 
 def lambda_handler(event, context):
-    hyp3 = HyP3(environ['HYP3_URL'], username=environ['EDL_USERNAME'], password=environ['EDL_PASSWORD'])
-    events = database.get_events()
-    for event in events:
-        handle_event(hyp3, event)
+    full_rescan = bool(event and event.get('full_rescan'))
+    hyp3 = clients.get_hyp3(environ['HYP3_URL'], environ['EDL_USERNAME'], environ['EDL_PASSWORD'])
+    events = get_events_to_search(full_rescan)
+    with ThreadPoolExecutor(max_workers=EVENT_CONCURRENCY) as executor:
+        futures = {event['event_id']: executor.submit(handle_event, hyp3, event, full_rescan) for event in events}
+    print(f'HTTP connection stats: {clients.get_connection_stats()}')
+
+    errors = {event_id: future.exception() for event_id, future in futures.items() if future.exception()}
+    for event_id, error in errors.items():
+        print(f'Error processing event {event_id}: {error!r}')
+    if errors:
+        raise RuntimeError(f'Failed to process {len(errors)} of {len(futures)} events: {list(errors)}')
@@ -1,40 +1,292 @@
-import io
+import math
+import re
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from mimetypes import guess_type
 from os import environ
 from os.path import basename
-from urllib.parse import urlparse
+from threading import Lock, Semaphore
+from urllib.parse import unquote, urlparse
 
 import boto3
 import requests
-from hyp3_sdk import HyP3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-from database import database
+from database import clients, database
 
 
-S3 = boto3.resource('s3')
+CHUNK_SIZE = 1024 * 1024
+PART_SIZE = int(environ.get('TRANSFER_PART_SIZE', 64 * 1024 * 1024))
+MAX_CONCURRENCY = int(environ.get('TRANSFER_CONCURRENCY', 4))
+HARVEST_CONCURRENCY = int(environ.get('HARVEST_CONCURRENCY', 4))
+# Pending products older than this are looked up individually rather than widening the bulk job search
+JOB_SEARCH_WINDOW = timedelta(days=7)
+# Conservative per-product transfer rate and fixed overhead used to predict how long a harvest will take
+TRANSFER_THROUGHPUT = int(environ.get('TRANSFER_THROUGHPUT', 20 * 1024 * 1024))
+PRODUCT_OVERHEAD_SECONDS = 10
+# Time left unused at the end of each run so the harvest cursor can be saved before Lambda times out
+TIME_BUDGET_MARGIN_SECONDS = 30
+HARVEST_CURSOR_ID = 'harvest_products_cursor'
+LAMBDA_MEMORY_SIZE = int(environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 2048)) * 1024 * 1024
+# Part buffers held in memory at once across all transfers; defaults to a quarter of the Lambda function's memory
+MAX_BUFFERED_PARTS = max(2, int(environ.get('TRANSFER_MAX_BUFFERED_PARTS', LAMBDA_MEMORY_SIZE // 4 // PART_SIZE)))
+PART_BUFFERS = Semaphore(MAX_BUFFERED_PARTS)
+PART_BUFFERS_LOCK = Lock()
+MAX_CONNECTIONS = HARVEST_CONCURRENCY * 3 * MAX_CONCURRENCY
+S3 = boto3.resource('s3', config=Config(max_pool_connections=MAX_CONNECTIONS))
+
+
+def get_download_session():
+    return clients.get_session('download', pool_maxsize=MAX_CONNECTIONS)
+
+
+@contextmanager
+def part_buffers(count=1):
+    # Reserving several buffers under one lock keeps two transfers from each holding one while waiting for another
+    with PART_BUFFERS_LOCK:
+        for _ in range(count):
+            PART_BUFFERS.acquire()
+    try:
+        yield
+    finally:
+        for _ in range(count):
+            PART_BUFFERS.release()
+
+
+def upload_part(bucket, key, upload_id, part_number, body):
+    response = S3.meta.client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body)
+    return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+
+def multipart_upload(bucket, key, content_type, upload_parts):
+    upload_id = S3.meta.client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+    try:
+        uploaded_parts = upload_parts(upload_id)
+    except Exception:
+        S3.meta.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    S3.meta.client.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': uploaded_parts}
+    )
+
+
+def iter_parts(response, part_size):
+    part = bytearray()
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+        part += chunk
+        if len(part) >= part_size:
+            yield part
+            part = bytearray()
+    if part:
+        yield part
+
+
+def stream_to_s3(response, bucket, key, content_type):
+    with part_buffers(2):
+        buffered_stream_to_s3(response, bucket, key, content_type)
+
+
+def buffered_stream_to_s3(response, bucket, key, content_type):
+    parts = iter_parts(response, PART_SIZE)
+    part = next(parts, bytearray())
+    next_part = next(parts, None)
+    if next_part is None:
+        S3.meta.client.put_object(Bucket=bucket, Key=key, Body=part, ContentType=content_type)
+        return
+
+    def upload_parts(upload_id):
+        nonlocal part, next_part
+        uploaded_parts: list[dict] = []
+        while part is not None:
+            uploaded_parts.append(upload_part(bucket, key, upload_id, len(uploaded_parts) + 1, part))
+            part, next_part = next_part, next(parts, None)
+        return uploaded_parts
+
+    multipart_upload(bucket, key, content_type, upload_parts)
+
+
+def download_range(file_url, start, end):
+    response = get_download_session().get(file_url, headers={'Range': f'bytes={start}-{end}'})
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise requests.HTTPError(f'Expected a partial response for {file_url} but got {response.status_code}')
+    return response.content
+
+
+def get_content_range_size(response):
+    size = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(size) if size.isdigit() else None
+
+
+def ranged_to_s3(file_url, response, bucket, key, content_type):
+    size = get_content_range_size(response)
+    if size <= PART_SIZE:
+        with part_buffers():
+            S3.meta.client.put_object(Bucket=bucket, Key=key, Body=response.content, ContentType=content_type)
+        return
+
+    def transfer_part(upload_id, part_number):
+        start = (part_number - 1) * PART_SIZE
+        end = min(start + PART_SIZE, size) - 1
+        with part_buffers():
+            return upload_part(bucket, key, upload_id, part_number, download_range(file_url, start, end))
+
+    def upload_parts(upload_id):
+        part_numbers = range(2, math.ceil(size / PART_SIZE) + 1)
+        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        try:
+            uploaded_parts = executor.map(lambda part_number: transfer_part(upload_id, part_number), part_numbers)
+            with part_buffers():
+                uploaded_first_part = upload_part(bucket, key, upload_id, 1, response.content)
+            return [uploaded_first_part, *uploaded_parts]
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    multipart_upload(bucket, key, content_type, upload_parts)
+
+
+def get_s3_location(url):
+    parsed_url = urlparse(url)
+    virtual_host = re.fullmatch(r'(?P<bucket>.+)\.s3([.-][a-z0-9-]+)?\.amazonaws\.com', parsed_url.netloc)
+    if virtual_host:
+        bucket, key = virtual_host['bucket'], parsed_url.path[1:]
+    elif re.fullmatch(r's3([.-][a-z0-9-]+)?\.amazonaws\.com', parsed_url.netloc):
+        bucket, _, key = parsed_url.path[1:].partition('/')
+    else:
+        return None
+    return (bucket, unquote(key)) if bucket and key else None
+
+
+def get_existing_object(bucket, key):
+    try:
+        return S3.meta.client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return None
+        if e.response['Error']['Code'] in ['403', 'AccessDenied']:
+            print(f'Unable to check for an existing {key}, harvesting it again: {e}')
+            return None
+        raise
+
+
+def is_same_object(source, existing):
+    # Multipart ETags depend on the part size used for the upload, so they are only comparable when neither is one
+    if '-' in source['ETag'] or '-' in existing['ETag']:
+        return source['ContentLength'] == existing['ContentLength']
+    return source['ETag'] == existing['ETag']
+
+
+def copy_to_s3(source_bucket, source_key, bucket, key, content_type, existing_object=None):
+    copy_source = {'Bucket': source_bucket, 'Key': source_key}
+    source_object = S3.meta.client.head_object(**copy_source)
+    if existing_object is not None and is_same_object(source_object, existing_object):
+        print(f'{key} is already harvested, skipping')
+        return
+
+    size = source_object['ContentLength']
+
+    if size <= PART_SIZE:
+        S3.meta.client.copy_object(
+            CopySource=copy_source, Bucket=bucket, Key=key, ContentType=content_type, MetadataDirective='REPLACE'
+        )
+        return
+
+    def copy_part(upload_id, part_number):
+        start = (part_number - 1) * PART_SIZE
+        end = min(start + PART_SIZE, size) - 1
+        response = S3.meta.client.upload_part_copy(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource=copy_source,
+            CopySourceRange=f'bytes={start}-{end}',
+        )
+        return {'ETag': response['CopyPartResult']['ETag'], 'PartNumber': part_number}
+
+    def upload_parts(upload_id):
+        part_numbers = range(1, math.ceil(size / PART_SIZE) + 1)
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            return list(executor.map(lambda part_number: copy_part(upload_id, part_number), part_numbers))
+
+    multipart_upload(bucket, key, content_type, upload_parts)
+
+
+def get_response_size(response):
+    if response.status_code == 206:
+        return get_content_range_size(response)
+    if 'Content-Length' in response.headers:
+        return int(response.headers['Content-Length'])
+    return None
+
+
+def download_to_s3(file_url, bucket, key, content_type, existing_object=None):
+    with get_download_session().get(file_url, headers={'Range': f'bytes=0-{PART_SIZE - 1}'}, stream=True) as response:
+        response.raise_for_status()
+        # An S3 object only exists once its upload completes, and HTTP sources have no ETag comparable to ours, so a
+        # destination object of the same size is a finished earlier transfer of this (immutable) HyP3 output
+        if existing_object is not None and get_response_size(response) == existing_object['ContentLength']:
+            print(f'{key} is already harvested, skipping')
+            return
+        if response.status_code != 206:
+            stream_to_s3(response, bucket, key, content_type)
+            return
+        if get_content_range_size(response) is not None:
+            ranged_to_s3(file_url, response, bucket, key, content_type)
+            return
+
+    print(f'Total size of {file_url} is unknown, downloading as a single stream')
+    with get_download_session().get(file_url, stream=True) as response:
+        response.raise_for_status()
+        stream_to_s3(response, bucket, key, content_type)
 
 
 def harvest_file(file_url, destination_prefix):
-    destination_bucket = S3.Bucket(environ['BUCKET_NAME'])
+    destination_bucket = environ['BUCKET_NAME']
     filename = basename(urlparse(file_url).path)
     destination_key = f'{destination_prefix}/{filename}'
-    response = requests.get(file_url)
-    response.raise_for_status()
     content_type = guess_type(filename)[0] if guess_type(filename)[0] else 'application/octet-stream'
-    destination_bucket.put_object(Body=io.BytesIO(response.content), Key=destination_key, ContentType=content_type)
-    return f'https://{destination_bucket.name}.s3.amazonaws.com/{destination_key}'
+    existing_object = get_existing_object(destination_bucket, destination_key)
+    source_location = get_s3_location(file_url)
+    if source_location is None:
+        download_to_s3(file_url, destination_bucket, destination_key, content_type, existing_object)
+    else:
+        source_bucket, source_key = source_location
+        try:
+            copy_to_s3(source_bucket, source_key, destination_bucket, destination_key, content_type, existing_object)
+        except ClientError as e:
+            print(f'Unable to copy {file_url} within S3, downloading instead: {e}')
+            download_to_s3(file_url, destination_bucket, destination_key, content_type, existing_object)
+    return f'https://{destination_bucket}.s3.amazonaws.com/{destination_key}'
 
 
 def harvest(product, job):
     destination_prefix = f'{product["event_id"]}/{product["product_id"]}'
     product_file = job.files[0]
+    files = product.get('files', {})
+
+    def harvest_missing_file(name, file_url):
+        if name in files:
+            print(f'{name} for product {product["product_id"]} is already harvested, skipping')
+            return files[name]
+        url = harvest_file(file_url, destination_prefix)
+        database.set_product_file(product['event_id'], product['product_id'], name, url)
+        return url
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        browse_url = executor.submit(harvest_missing_file, 'browse_url', job.browse_images[0])
+        thumbnail_url = executor.submit(harvest_missing_file, 'thumbnail_url', job.thumbnail_images[0])
+        product_url = executor.submit(harvest_missing_file, 'product_url', product_file['url'])
 
     return {
-        'browse_url': harvest_file(job.browse_images[0], destination_prefix),
-        'thumbnail_url': harvest_file(job.thumbnail_images[0], destination_prefix),
+        'browse_url': browse_url.result(),
+        'thumbnail_url': thumbnail_url.result(),
         'product_name': product_file['filename'],
         'product_size': product_file['size'],
-        'product_url': harvest_file(product_file['url'], destination_prefix),
+        'product_url': product_url.result(),
     }
 
 
@@ -47,11 +299,87 @@ def update_product(product, job):
     database.put_product(product)
 
 
-def lambda_handler(event, context):
-    products = database.get_products_by_status('PENDING')
-    hyp3 = HyP3(environ['HYP3_URL'], username=environ['EDL_USERNAME'], password=environ['EDL_PASSWORD'])
-    for product in products:
-        print(f'Checking on product: {product["product_id"]}')
+def get_completed_jobs(hyp3, products):
+    window_start = (datetime.now(tz=timezone.utc) - JOB_SEARCH_WINDOW).isoformat(timespec='seconds')
+    recent_products = [product for product in products if product['processing_date'] >= window_start]
+    older_products = [product for product in products if product['processing_date'] < window_start]
+
+    jobs = {}
+    if recent_products:
+        start = min(product['processing_date'] for product in recent_products)
+        for status_code in ['SUCCEEDED', 'FAILED']:
+            for job in hyp3.find_jobs(start=start, status_code=status_code):
+                jobs[job.job_id] = job
+
+    for product in older_products:
         job = hyp3.get_job_by_id(product['product_id'])
         if job.complete():
-            update_product(product, job)
+            jobs[job.job_id] = job
+    return jobs
+
+
+def predict_harvest_seconds(job):
+    if not job.succeeded():
+        return PRODUCT_OVERHEAD_SECONDS
+    return PRODUCT_OVERHEAD_SECONDS + sum(file['size'] for file in job.files or []) / TRANSFER_THROUGHPUT
+
+
+def get_cursor_key(product):
+    return product['processing_date'], product['product_id']
+
+
+def order_from_cursor(products, cursor):
+    products = sorted(products, key=get_cursor_key)
+    if cursor is None:
+        return products
+    cursor_key = (cursor['processing_date'], cursor['product_id'])
+    return [product for product in products if get_cursor_key(product) >= cursor_key] + [
+        product for product in products if get_cursor_key(product) < cursor_key
+    ]
+
+
+def save_cursor(skipped_products):
+    cursor = None
+    if skipped_products:
+        cursor = {key: skipped_products[0][key] for key in ['processing_date', 'product_id']}
+        print(f'Out of time, {len(skipped_products)} products left for the next run starting with {cursor}')
+    database.put_state({'state_id': HARVEST_CURSOR_ID, 'cursor': cursor})
+
+
+def get_remaining_seconds(context):
+    if context is None:
+        return math.inf
+    return context.get_remaining_time_in_millis() / 1000 - TIME_BUDGET_MARGIN_SECONDS
+
+
+def lambda_handler(event, context):
+    products = database.get_products_by_status('PENDING')
+    hyp3 = clients.get_hyp3(environ['HYP3_URL'], environ['EDL_USERNAME'], environ['EDL_PASSWORD'])
+    jobs = get_completed_jobs(hyp3, products)
+    completed_products = [product for product in products if product['product_id'] in jobs]
+    print(f'{len(completed_products)} of {len(products)} pending products are complete')
+
+    state = database.get_state(HARVEST_CURSOR_ID) or {}
+    completed_products = order_from_cursor(completed_products, state.get('cursor'))
+    futures: dict[str, Future] = {}
+    skipped_products = []
+    with ThreadPoolExecutor(max_workers=HARVEST_CONCURRENCY) as executor:
+        for index, product in enumerate(completed_products):
+            running = [future for future in futures.values() if not future.done()]
+            if len(running) >= HARVEST_CONCURRENCY:
+                wait(running, return_when=FIRST_COMPLETED)
+
+            job = jobs[product['product_id']]
+            if predict_harvest_seconds(job) > get_remaining_seconds(context):
+                skipped_products = completed_products[index:]
+                break
+            futures[product['product_id']] = executor.submit(update_product, product, job)
+
+    save_cursor(skipped_products)
+    print(f'HTTP connection stats: {clients.get_connection_stats()}')
+
+    errors = {product_id: future.exception() for product_id, future in futures.items() if future.exception()}
+    for product_id, error in errors.items():
+        print(f'Error updating product {product_id}: {error!r}')
+    if errors:
+        raise RuntimeError(f'Failed to update {len(errors)} of {len(futures)} products: {list(errors)}')
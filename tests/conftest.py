@@ -1,5 +1,8 @@
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import environ
 from pathlib import Path
+from threading import Thread
 
 import boto3
 import pytest
@@ -9,7 +12,7 @@ from moto import mock_aws
 
 import api
 import harvest_products
-from database import database
+from database import clients, database
 
 
 def get_table_properties_from_template(resource_name):
@@ -21,6 +24,13 @@ def get_table_properties_from_template(resource_name):
     return table_properties
 
 
+@pytest.fixture(autouse=True)
+def clear_clients():
+    yield
+    clients.SESSIONS.clear()
+    clients.HYP3_CLIENTS.clear()
+
+
 @pytest.fixture
 def tables():
     with mock_aws():
@@ -34,6 +44,9 @@ def tables():
             product_table = database.DB.create_table(
                 TableName=environ['PRODUCT_TABLE'], **get_table_properties_from_template('ProductTable')
             )
+            state_table = database.DB.create_table(
+                TableName=environ['STATE_TABLE'], **get_table_properties_from_template('StateTable')
+            )
 
         tables = Tables()
         yield tables
@@ -50,3 +63,68 @@ def s3_stubber():
 def api_client():
     with api.app.test_client() as client:
         yield client
+
+
+def file_content(start, end):
+    return bytes(i % 251 for i in range(start, end))
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """Serves `/<size>/<filename>` as generated content, optionally honoring `Range` headers"""
+
+    server: 'FileServer'
+    chunk_size = 16 * 1024
+    pattern = file_content(0, chunk_size + 251)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        size = int(self.path.split('/')[1])
+        start, end = 0, size
+        if self.server.accept_ranges and 'Range' in self.headers:
+            first, last = self.headers['Range'].removeprefix('bytes=').split('-')
+            start, end = int(first), min(int(last) + 1, size)
+            self.send_response(206)
+            total = size if self.server.known_size else '*'
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{total}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        for offset in range(start, end, self.chunk_size):
+            length = min(self.chunk_size, end - offset)
+            self.wfile.write(self.pattern[offset % 251 : offset % 251 + length])
+            time.sleep(self.server.delay)
+
+
+class FileServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileRequestHandler)
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.accept_ranges = True
+        self.known_size = True
+        self.delay = 0.0
+        self.requests: list[str | None] = []
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    with mock_aws():
+        monkeypatch.setattr(harvest_products, 'S3', boto3.resource('s3'))
+        bucket = harvest_products.S3.create_bucket(
+            Bucket=environ['BUCKET_NAME'],
+            CreateBucketConfiguration={'LocationConstraint': environ['AWS_DEFAULT_REGION']},
+        )
+        yield bucket
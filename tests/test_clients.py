@@ -0,0 +1,68 @@
+import time
+from unittest.mock import patch
+
+import responses
+from hyp3_sdk.util import AUTH_URL
+from requests.cookies import create_cookie
+
+from database import clients
+
+
+def test_get_session():
+    session = clients.get_session('foo')
+    assert clients.get_session('foo') is session
+    assert clients.get_session('bar') is not session
+
+
+@responses.activate
+def test_get_session_retries():
+    responses.add(responses.POST, 'https://foo.com/search', status=503)
+    responses.add(responses.POST, 'https://foo.com/search', json={'results': []})
+    responses.add(responses.GET, 'https://foo.com/file', status=503)
+
+    with patch('database.clients.BACKOFF_FACTOR', 0):
+        response = clients.get_session('search', retry_post=True).post('https://foo.com/search')
+        assert response.status_code == 200
+        assert len(responses.calls) == 2
+
+        response = clients.get_session('download').get('https://foo.com/file')
+        assert response.status_code == 503
+        assert len(responses.calls) == 6
+
+        response = clients.get_session('no_post_retries').post('https://foo.com/search')
+        assert response.status_code == 200
+        assert len(responses.calls) == 7
+
+
+def test_get_connection_stats(file_server):
+    stats = clients.get_connection_stats()
+    session = clients.get_session('download')
+    for _ in range(3):
+        session.get(f'{file_server.url}/10/file.zip').raise_for_status()
+
+    new_stats = clients.get_connection_stats()
+    assert new_stats['connections'] - stats['connections'] == 1
+    assert new_stats['requests'] - stats['requests'] == 3
+    assert new_stats['reused'] - stats['reused'] == 2
+
+
+@responses.activate
+def test_get_hyp3():
+    responses.add(responses.GET, AUTH_URL)
+    logins = clients.HYP3_LOGINS
+
+    hyp3 = clients.get_hyp3('https://hyp3.com', 'user', 'password')
+    assert clients.get_hyp3('https://hyp3.com', 'user', 'password') is hyp3
+    assert clients.HYP3_LOGINS == logins + 1
+    assert len(responses.calls) == 1
+
+    hyp3.session.cookies.set_cookie(create_cookie('asf-urs', 'token', expires=int(time.time()) + 3600))
+    assert clients.get_hyp3('https://hyp3.com', 'user', 'password') is hyp3
+
+    hyp3.session.cookies.set_cookie(create_cookie('asf-urs', 'token', expires=int(time.time()) + 60))
+    refreshed_hyp3 = clients.get_hyp3('https://hyp3.com', 'user', 'password')
+    assert refreshed_hyp3 is not hyp3
+    assert clients.HYP3_LOGINS == logins + 2
+    assert len(responses.calls) == 2
+
+    assert clients.get_hyp3('https://other-hyp3.com', 'user', 'password') is not refreshed_hyp3
@@ -44,6 +44,21 @@ def test_get_products_for_event(tables):
     assert database.get_products_for_event('1', 'PENDING') == products[2:3]
 
 
+def test_get_processed_granule_names(tables):
+    products = [
+        {'event_id': '1', 'product_id': '1', 'granules': [{'granule_name': 'a', 'wkt': 'foo'}]},
+        {'event_id': '1', 'product_id': '2', 'granules': [{'granule_name': 'b'}, {'granule_name': 'c'}]},
+        {'event_id': '1', 'product_id': '3', 'granules': [{'granule_name': 'a'}, {'granule_name': 'd'}]},
+        {'event_id': '2', 'product_id': '4', 'granules': [{'granule_name': 'e'}]},
+    ]
+    for product in products:
+        tables.product_table.put_item(Item=product)
+
+    assert database.get_processed_granule_names('foo') == set()
+    assert database.get_processed_granule_names('1') == {'a', 'b'}
+    assert database.get_processed_granule_names('2') == {'e'}
+
+
 def test_get_products_by_status(tables):
     products = [
         {
@@ -92,3 +107,50 @@ def test_put_product(tables):
     product2 = {'event_id': 'event2', 'product_id': 'bar'}
     database.put_product(product2)
     assert tables.product_table.scan()['Items'] == [product1, product2]
+
+
+def test_set_product_file(tables):
+    tables.product_table.put_item(Item={'event_id': 'event1', 'product_id': 'foo'})
+
+    database.set_product_file('event1', 'foo', 'browse_url', 'BROWSE_URL')
+    database.set_product_file('event1', 'foo', 'product_url', 'PRODUCT_URL')
+
+    assert tables.product_table.scan()['Items'] == [
+        {
+            'event_id': 'event1',
+            'product_id': 'foo',
+            'files': {'browse_url': 'BROWSE_URL', 'product_url': 'PRODUCT_URL'},
+        }
+    ]
+
+
+def test_get_state(tables):
+    assert database.get_state('foo') is None
+
+    database.put_state({'state_id': 'foo', 'cursor': {'product_id': 'bar'}})
+    assert database.get_state('foo') == {'state_id': 'foo', 'cursor': {'product_id': 'bar'}}
+
+    database.put_state({'state_id': 'foo', 'cursor': None})
+    assert database.get_state('foo') == {'state_id': 'foo', 'cursor': None}
+
+
+def test_update_event(tables):
+    tables.event_table.put_item(Item={'event_id': 'foo', 'wkt': 'POINT (0 0)'})
+
+    database.update_event('foo', {'search_watermark': '2020-01-01T00:00:00+00:00', 'name': 'bar'})
+    assert tables.event_table.scan()['Items'] == [
+        {'event_id': 'foo', 'wkt': 'POINT (0 0)', 'search_watermark': '2020-01-01T00:00:00+00:00', 'name': 'bar'}
+    ]
+
+
+def test_get_active_events(tables):
+    events = [
+        {'event_id': 'foo', 'event_status': 'ACTIVE'},
+        {'event_id': 'bar', 'event_status': 'CLOSED'},
+        {'event_id': 'baz'},
+        {'event_id': 'qux', 'event_status': 'ACTIVE'},
+    ]
+    for event in events:
+        tables.event_table.put_item(Item=event)
+
+    assert sorted(event['event_id'] for event in database.get_active_events()) == ['foo', 'qux']
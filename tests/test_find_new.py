@@ -1,5 +1,9 @@
 import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
 from os import environ
+from threading import Barrier
 from unittest.mock import MagicMock, NonCallableMagicMock, call, patch
 from uuid import uuid4
 
@@ -10,8 +14,10 @@ from dateutil import parser
 from hyp3_sdk import HyP3
 from hyp3_sdk.exceptions import HyP3Error, ServerError
 from hyp3_sdk.util import AUTH_URL
+from responses import matchers
 
 import find_new
+from database import database
 
 
 @responses.activate
@@ -49,6 +55,33 @@ def test_get_granules():
     assert response == mock_response['results']
 
 
+@responses.activate
+def test_get_granules_incremental():
+    event = {
+        'event_id': 'foo',
+        'processing_timeframe': {'start': '2020-01-01T00:00:00+00:00'},
+        'wkt': 'someWKT',
+        'search_watermark': '2020-01-10T12:00:00+00:00',
+    }
+    responses.add(
+        responses.GET,
+        find_new.SEARCH_URL,
+        json.dumps({'results': []}),
+        match=[
+            matchers.query_param_matcher(
+                {'start': '2020-01-01T00:00:00+00:00', 'processingDate': '2020-01-08T12:00:00+00:00'},
+                strict_match=False,
+            )
+        ],
+    )
+    with patch('find_new.SEARCH_OVERLAP', timedelta(days=2)):
+        assert find_new.get_granules(event) == []
+
+    responses.replace(responses.GET, find_new.SEARCH_URL, json.dumps({'results': []}))
+    find_new.get_granules(event, full_rescan=True)
+    assert 'processingDate' not in str(responses.calls[-1].request.url)
+
+
 @responses.activate
 def test_get_unprocessed_granules(tables):
     mock_response = {
@@ -464,6 +497,7 @@ def test_lambda_handler(tables):
             'end': '2020-01-02T00:00:00+00:00',
         },
         'wkt': 'foo',
+        'event_status': 'ACTIVE',
     }
     tables.event_table.put_item(Item=mock_event)
 
@@ -592,3 +626,203 @@ def test_lambda_handler(tables):
     assert products[3]['job_type'] == 'INSAR_GAMMA'
     assert products[3]['granules'][0]['granule_name'] == 'granule3'
     assert products[3]['granules'][1]['granule_name'] == 'neighbor2'
+
+
+def add_events(tables, count, start=0):
+    for index in range(start, start + count):
+        tables.event_table.put_item(
+            Item={
+                'event_id': f'event{index}',
+                'processing_timeframe': {'start': '2020-01-01T00:00:00+00:00'},
+                'wkt': 'foo',
+                'event_status': 'ACTIVE',
+            }
+        )
+
+
+@responses.activate
+def test_lambda_handler_events_concurrently(tables):
+    add_events(tables, 3)
+    responses.add(responses.GET, AUTH_URL)
+    all_events_started = Barrier(3, timeout=5)
+
+    def mock_handle_event(hyp3, event, full_rescan):
+        all_events_started.wait()
+
+    with patch('find_new.handle_event', mock_handle_event), patch('find_new.EVENT_CONCURRENCY', 3):
+        find_new.lambda_handler(None, None)
+
+
+@responses.activate
+def test_lambda_handler_event_errors(tables, capsys):
+    add_events(tables, 3)
+    responses.add(responses.GET, AUTH_URL)
+    handled_events = []
+
+    def mock_handle_event(hyp3, event, full_rescan):
+        if event['event_id'] != 'event1':
+            raise ValueError(f'bad event {event["event_id"]}')
+        handled_events.append(event['event_id'])
+
+    with patch('find_new.handle_event', mock_handle_event):
+        with pytest.raises(RuntimeError, match=r'Failed to process 2 of 3 events'):
+            find_new.lambda_handler(None, None)
+
+    assert handled_events == ['event1']
+    output = capsys.readouterr().out
+    assert "Error processing event event0: ValueError('bad event event0')" in output
+    assert "Error processing event event2: ValueError('bad event event2')" in output
+
+
+@pytest.mark.benchmark
+@responses.activate
+def test_lambda_handler_benchmark(tables):
+    responses.add(responses.GET, AUTH_URL)
+
+    def mock_get_granules(event):
+        # Stand-in for the blocking ASF search request made for each event
+        time.sleep(0.05)
+        return []
+
+    def time_lambda_handler(concurrency):
+        start = time.perf_counter()
+        with patch('find_new.get_granules', mock_get_granules), patch('find_new.EVENT_CONCURRENCY', concurrency):
+            find_new.lambda_handler(None, None)
+        return time.perf_counter() - start
+
+    event_count = 0
+    for total_events in [8, 16, 32]:
+        add_events(tables, total_events - event_count, start=event_count)
+        event_count = total_events
+        sequential_seconds = time_lambda_handler(1)
+        concurrent_seconds = time_lambda_handler(8)
+        print(f'{total_events} events: sequential {sequential_seconds:.3f}s, concurrent {concurrent_seconds:.3f}s')
+        assert concurrent_seconds * 3 < sequential_seconds
+
+
+@responses.activate
+def test_handle_event_search_watermark(tables):
+    event = {'event_id': 'event1', 'processing_timeframe': {'start': '2020-01-01T00:00:00+00:00'}, 'wkt': 'foo'}
+    tables.event_table.put_item(Item=event)
+    granules = [{'granuleName': 'granule1'}, {'granuleName': 'granule2'}]
+
+    with (
+        patch('find_new.get_unprocessed_granules', return_value=granules) as mock_get_unprocessed_granules,
+        patch('find_new.submit_jobs_for_granule', side_effect=[True, False]),
+    ):
+        find_new.handle_event(None, event)
+    mock_get_unprocessed_granules.assert_called_once_with(event, False)
+    assert 'search_watermark' not in tables.event_table.get_item(Key={'event_id': 'event1'})['Item']
+
+    with (
+        patch('find_new.get_unprocessed_granules', return_value=granules),
+        patch('find_new.submit_jobs_for_granule', side_effect=[True, find_new.GranuleError]),
+        patch('find_new.add_invalid_product_record'),
+    ):
+        find_new.handle_event(None, event, full_rescan=True)
+    search_watermark = tables.event_table.get_item(Key={'event_id': 'event1'})['Item']['search_watermark']
+    assert datetime.now(tz=timezone.utc) - parser.parse(search_watermark) < timedelta(minutes=1)
+
+
+@responses.activate
+def test_lambda_handler_full_rescan(tables):
+    add_events(tables, 1)
+    responses.add(responses.GET, AUTH_URL)
+
+    with patch('find_new.handle_event') as mock_handle_event:
+        find_new.lambda_handler({'full_rescan': True}, None)
+        find_new.lambda_handler({}, None)
+
+    assert [mock_call.args[2] for mock_call in mock_handle_event.mock_calls] == [True, False]
+
+
+def test_handle_event_closes_event(tables):
+    event = {
+        'event_id': 'event1',
+        'processing_timeframe': {'start': '2020-01-01T00:00:00+00:00', 'end': '2020-02-01T00:00:00+00:00'},
+        'event_status': 'ACTIVE',
+    }
+    tables.event_table.put_item(Item=event)
+
+    with patch('find_new.get_unprocessed_granules', return_value=[]):
+        with patch('find_new.EVENT_CATCH_UP', timedelta(days=365 * 100)):
+            find_new.handle_event(None, event)
+        assert tables.event_table.get_item(Key={'event_id': 'event1'})['Item']['event_status'] == 'ACTIVE'
+
+        find_new.handle_event(None, event)
+        assert tables.event_table.get_item(Key={'event_id': 'event1'})['Item']['event_status'] == 'CLOSED'
+
+
+def test_is_catch_up_complete():
+    event = {'processing_timeframe': {'start': '2020-01-01T00:00:00+00:00', 'end': '2020-02-01T00:00:00+00:00'}}
+    with patch('find_new.EVENT_CATCH_UP', timedelta(days=7)):
+        assert not find_new.is_catch_up_complete(event, '2020-02-08T00:00:00+00:00')
+        assert find_new.is_catch_up_complete(event, '2020-02-08T00:00:01+00:00')
+        assert not find_new.is_catch_up_complete({'processing_timeframe': {}}, '2100-01-01T00:00:00+00:00')
+
+
+@responses.activate
+def test_lambda_handler_active_events(tables):
+    for event_id, event_status in [('active', 'ACTIVE'), ('closed', 'CLOSED'), ('unregistered', None)]:
+        event = {'event_id': event_id, 'processing_timeframe': {'start': '2020-01-01T00:00:00+00:00'}}
+        if event_status:
+            event['event_status'] = event_status
+        tables.event_table.put_item(Item=event)
+    responses.add(responses.GET, AUTH_URL)
+
+    with patch('find_new.handle_event') as mock_handle_event:
+        find_new.lambda_handler({}, None)
+    assert [mock_call.args[1]['event_id'] for mock_call in mock_handle_event.mock_calls] == ['active']
+
+    with patch('find_new.handle_event') as mock_handle_event:
+        find_new.lambda_handler({'full_rescan': True}, None)
+    assert sorted(mock_call.args[1]['event_id'] for mock_call in mock_handle_event.mock_calls) == [
+        'active',
+        'unregistered',
+    ]
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('product_count', [10_000, 100_000])
+def test_get_unprocessed_granules_benchmark(tables, product_count):
+    footprint = 'POLYGON ((' + ', '.join(f'{index} {index}' for index in range(20)) + ', 0 0))'
+    with tables.product_table.batch_writer() as batch:
+        for index in range(product_count):
+            batch.put_item(
+                Item={
+                    'event_id': 'event1',
+                    'product_id': str(index),
+                    'granules': [{'granule_name': f'granule{index}', 'wkt': footprint} for _ in range(2)],
+                }
+            )
+    search_results = [{'granuleName': f'granule{index}'} for index in range(0, 2 * product_count, 2)]
+
+    def whole_product_list_dedupe():
+        products = database.get_products_for_event('event1')
+        processed_granule_names = [product['granules'][0]['granule_name'] for product in products]
+        return [granule for granule in search_results[:1000] if granule['granuleName'] not in processed_granule_names]
+
+    def projected_set_dedupe():
+        processed_granule_names = database.get_processed_granule_names('event1')
+        return [granule for granule in search_results if granule['granuleName'] not in processed_granule_names]
+
+    def measure(dedupe):
+        tracemalloc.start()
+        start = time.perf_counter()
+        unprocessed = dedupe()
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return unprocessed, seconds, peak
+
+    # The list-based dedupe is only given the first 1000 search results to keep its O(n*m) check tractable
+    list_unprocessed, list_seconds, list_peak = measure(whole_product_list_dedupe)
+    set_unprocessed, set_seconds, set_peak = measure(projected_set_dedupe)
+
+    print(
+        f'{product_count} products: whole products and list {list_seconds:.2f}s {list_peak / 2**20:.0f} MiB '
+        f'(1000 results), projection and set {set_seconds:.2f}s {set_peak / 2**20:.0f} MiB ({product_count} results)'
+    )
+    assert list_unprocessed == []
+    assert len(set_unprocessed) == product_count // 2
+    assert set_peak * 2 < list_peak
@@ -1,26 +1,322 @@
+import json
+import re
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
 from os import environ
+from threading import Barrier, Semaphore
 from unittest.mock import MagicMock, call, patch
 
+import pytest
 import responses
+from botocore.exceptions import ClientError
 from botocore.stub import ANY
 from dateutil import parser
+from hyp3_sdk import HyP3
 from hyp3_sdk.jobs import Job
+from hyp3_sdk.util import AUTH_URL
 
 import harvest_products
+from conftest import file_content
+
+
+def add_not_found_response(s3_stubber, key):
+    s3_stubber.add_client_error(
+        method='head_object',
+        service_error_code='404',
+        http_status_code=404,
+        expected_params={'Bucket': environ['BUCKET_NAME'], 'Key': key},
+    )
 
 
 @responses.activate
 def test_harvest_file(s3_stubber):
     responses.add(responses.GET, 'https://foo.com/file.png', body='image_content')
+    add_not_found_response(s3_stubber, 'prefix/file.png')
+    params = {'Bucket': environ['BUCKET_NAME'], 'Key': 'prefix/file.png', 'ContentType': 'image/png', 'Body': ANY}
+    s3_stubber.add_response(method='put_object', expected_params=params, service_response={})
+    response = harvest_products.harvest_file('https://foo.com/file.png', 'prefix')
+
+    assert response == f'https://{environ["BUCKET_NAME"]}.s3.amazonaws.com/prefix/file.png'
+
+
+def add_multipart_responses(s3_stubber, key, content_type, part_count):
+    add_not_found_response(s3_stubber, key)
+    params = {'Bucket': environ['BUCKET_NAME'], 'Key': key}
+    s3_stubber.add_response(
+        method='create_multipart_upload',
+        expected_params={**params, 'ContentType': content_type},
+        service_response={'UploadId': 'upload-id'},
+    )
+    for part_number in range(1, part_count + 1):
+        s3_stubber.add_response(
+            method='upload_part',
+            expected_params={**params, 'UploadId': 'upload-id', 'PartNumber': part_number, 'Body': ANY},
+            service_response={'ETag': f'etag-{part_number}'},
+        )
+    parts = [{'ETag': f'etag-{part_number}', 'PartNumber': part_number} for part_number in range(1, part_count + 1)]
+    s3_stubber.add_response(
+        method='complete_multipart_upload',
+        expected_params={**params, 'UploadId': 'upload-id', 'MultipartUpload': {'Parts': parts}},
+        service_response={},
+    )
+
+
+@responses.activate
+def test_harvest_file_multipart(s3_stubber):
+    responses.add(responses.GET, 'https://foo.com/product.zip', body=b'a' * 25)
+    add_multipart_responses(s3_stubber, 'prefix/product.zip', 'application/zip', part_count=3)
+
+    with patch('harvest_products.PART_SIZE', 10), patch('harvest_products.CHUNK_SIZE', 4):
+        response = harvest_products.harvest_file('https://foo.com/product.zip', 'prefix')
+
+    assert response == f'https://{environ["BUCKET_NAME"]}.s3.amazonaws.com/prefix/product.zip'
+
+
+@responses.activate
+def test_harvest_file_multipart_aborted(s3_stubber):
+    responses.add(responses.GET, 'https://foo.com/product.zip', body=b'a' * 25)
+    add_not_found_response(s3_stubber, 'prefix/product.zip')
+    params = {'Bucket': environ['BUCKET_NAME'], 'Key': 'prefix/product.zip'}
+    s3_stubber.add_response(
+        method='create_multipart_upload',
+        expected_params={**params, 'ContentType': 'application/zip'},
+        service_response={'UploadId': 'upload-id'},
+    )
+    s3_stubber.add_client_error(method='upload_part', service_error_code='InternalError', http_status_code=500)
+    s3_stubber.add_response(
+        method='abort_multipart_upload',
+        expected_params={**params, 'UploadId': 'upload-id'},
+        service_response={},
+    )
+
+    with patch('harvest_products.PART_SIZE', 10), patch('harvest_products.CHUNK_SIZE', 4):
+        with pytest.raises(ClientError):
+            harvest_products.harvest_file('https://foo.com/product.zip', 'prefix')
+
+
+def test_harvest_file_memory_is_bounded(s3_stubber, file_server):
+    file_server.accept_ranges = False
+    part_size = 1024 * 1024
+    peaks = []
+    for file_size in [4 * part_size, 32 * part_size]:
+        add_multipart_responses(s3_stubber, 'prefix/product.zip', 'application/zip', file_size // part_size)
+        tracemalloc.start()
+        with patch('harvest_products.PART_SIZE', part_size), patch('harvest_products.CHUNK_SIZE', 64 * 1024):
+            harvest_products.harvest_file(f'{file_server.url}/{file_size}/product.zip', 'prefix')
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    assert peaks[1] < 4 * part_size
+    assert peaks[1] < 1.5 * peaks[0]
+
+
+def test_harvest_file_ranged(s3_bucket, file_server):
+    with patch('harvest_products.PART_SIZE', 1000), patch('harvest_products.MAX_CONCURRENCY', 3):
+        harvest_products.harvest_file(f'{file_server.url}/4500/product.zip', 'prefix')
+
+    assert sorted(file_server.requests) == [
+        'bytes=0-999',
+        'bytes=1000-1999',
+        'bytes=2000-2999',
+        'bytes=3000-3999',
+        'bytes=4000-4499',
+    ]
+    s3_object = s3_bucket.Object('prefix/product.zip').get()
+    assert s3_object['ContentType'] == 'application/zip'
+    assert s3_object['Body'].read() == file_content(0, 4500)
+
+
+def test_harvest_file_ranged_buffered_parts_are_bounded(s3_bucket, file_server):
+    in_flight = []
+    max_in_flight = 0
+    download_range = harvest_products.download_range
+
+    def mock_download_range(file_url, start, end):
+        nonlocal max_in_flight
+        in_flight.append(start)
+        max_in_flight = max(max_in_flight, len(in_flight))
+        time.sleep(0.01)
+        in_flight.remove(start)
+        return download_range(file_url, start, end)
+
+    with (
+        patch('harvest_products.PART_SIZE', 1000),
+        patch('harvest_products.MAX_CONCURRENCY', 8),
+        patch('harvest_products.PART_BUFFERS', Semaphore(2)),
+        patch('harvest_products.download_range', mock_download_range),
+    ):
+        harvest_products.harvest_file(f'{file_server.url}/9500/product.zip', 'prefix')
+
+    assert max_in_flight <= 2
+    assert s3_bucket.Object('prefix/product.zip').get()['Body'].read() == file_content(0, 9500)
+
+
+def test_harvest_file_ranged_single_part(s3_bucket, file_server):
+    with patch('harvest_products.PART_SIZE', 1000):
+        harvest_products.harvest_file(f'{file_server.url}/1000/product.zip', 'prefix')
+
+    assert file_server.requests == ['bytes=0-999']
+    assert s3_bucket.Object('prefix/product.zip').get()['Body'].read() == file_content(0, 1000)
+
+
+def test_harvest_file_ranges_not_supported(s3_bucket, file_server):
+    file_server.accept_ranges = False
+    with patch('harvest_products.PART_SIZE', 1000), patch('harvest_products.CHUNK_SIZE', 100):
+        harvest_products.harvest_file(f'{file_server.url}/4500/product.zip', 'prefix')
+
+    assert file_server.requests == ['bytes=0-999']
+    assert s3_bucket.Object('prefix/product.zip').get()['Body'].read() == file_content(0, 4500)
+
+
+def test_harvest_file_ranged_unknown_size(s3_bucket, file_server):
+    file_server.known_size = False
+    with patch('harvest_products.PART_SIZE', 1000), patch('harvest_products.CHUNK_SIZE', 100):
+        harvest_products.harvest_file(f'{file_server.url}/4500/product.zip', 'prefix')
+
+    assert file_server.requests == ['bytes=0-999', None]
+    assert s3_bucket.Object('prefix/product.zip').get()['Body'].read() == file_content(0, 4500)
+
+
+@pytest.mark.benchmark
+def test_harvest_file_ranged_benchmark(s3_bucket, file_server):
+    file_server.delay = 0.01
+    url = f'{file_server.url}/{1024 * 1024}/product.zip'
+
+    def time_harvest():
+        start = time.perf_counter()
+        with patch('harvest_products.PART_SIZE', 128 * 1024), patch('harvest_products.MAX_CONCURRENCY', 8):
+            harvest_products.harvest_file(url, 'prefix')
+        return time.perf_counter() - start
+
+    file_server.accept_ranges = False
+    single_stream_seconds = time_harvest()
+
+    file_server.accept_ranges = True
+    ranged_seconds = time_harvest()
+
+    print(f'single stream: {single_stream_seconds:.3f}s, ranged: {ranged_seconds:.3f}s')
+    assert ranged_seconds * 1.5 < single_stream_seconds
+
+
+def test_get_s3_location():
+    assert harvest_products.get_s3_location('https://foo.com/file.png') is None
+    assert harvest_products.get_s3_location('https://bucket.s3.amazonaws.com/') is None
+    assert harvest_products.get_s3_location('https://bucket.s3.amazonaws.com/prefix/file.png') == (
+        'bucket',
+        'prefix/file.png',
+    )
+    assert harvest_products.get_s3_location('https://my.bucket.s3.us-west-2.amazonaws.com/file%20name.png') == (
+        'my.bucket',
+        'file name.png',
+    )
+    assert harvest_products.get_s3_location('https://bucket.s3-us-west-2.amazonaws.com/file.png') == (
+        'bucket',
+        'file.png',
+    )
+    assert harvest_products.get_s3_location('https://s3.us-west-2.amazonaws.com/bucket/prefix/file.png') == (
+        'bucket',
+        'prefix/file.png',
+    )
+    assert harvest_products.get_s3_location('https://s3.amazonaws.com/bucket') is None
+
+
+def create_source_object(key, body):
+    source_bucket = harvest_products.S3.create_bucket(
+        Bucket='hyp3-contentbucket',
+        CreateBucketConfiguration={'LocationConstraint': environ['AWS_DEFAULT_REGION']},
+    )
+    source_bucket.put_object(Key=key, Body=body)
+    return f'https://hyp3-contentbucket.s3.{environ["AWS_DEFAULT_REGION"]}.amazonaws.com/{key}'
+
+
+def test_harvest_file_s3_copy(s3_bucket):
+    source_url = create_source_object('job_id/product.zip', file_content(0, 4500))
+
+    with patch('harvest_products.PART_SIZE', 10000):
+        response = harvest_products.harvest_file(source_url, 'prefix')
+
+    assert response == f'https://{environ["BUCKET_NAME"]}.s3.amazonaws.com/prefix/product.zip'
+    s3_object = s3_bucket.Object('prefix/product.zip').get()
+    assert s3_object['ContentType'] == 'application/zip'
+    assert s3_object['Body'].read() == file_content(0, 4500)
+
+
+def test_harvest_file_s3_multipart_copy(s3_bucket):
+    source_url = create_source_object('job_id/product.zip', file_content(0, 4500))
+
+    with patch('harvest_products.PART_SIZE', 1000):
+        harvest_products.harvest_file(source_url, 'prefix')
+
+    s3_object = s3_bucket.Object('prefix/product.zip').get()
+    assert s3_object['ContentType'] == 'application/zip'
+    assert s3_object['Body'].read() == file_content(0, 4500)
+
+
+@patch('harvest_products.download_to_s3')
+def test_harvest_file_s3_copy_fallback(mock_download_to_s3: MagicMock, s3_bucket):
+    create_source_object('job_id/other.zip', b'')
+    source_url = f'https://hyp3-contentbucket.s3.{environ["AWS_DEFAULT_REGION"]}.amazonaws.com/job_id/product.zip'
+
+    harvest_products.harvest_file(source_url, 'prefix')
+
+    assert mock_download_to_s3.mock_calls == [
+        call(source_url, environ['BUCKET_NAME'], 'prefix/product.zip', 'application/zip', None)
+    ]
+
+
+def test_harvest_file_s3_copy_already_harvested(s3_bucket):
+    source_url = create_source_object('job_id/product.zip', file_content(0, 4500))
+    s3_bucket.put_object(Key='prefix/product.zip', Body=file_content(0, 4500))
+
+    with (
+        patch('harvest_products.copy_to_s3', wraps=harvest_products.copy_to_s3) as mock_copy_to_s3,
+        patch.object(harvest_products.S3.meta.client, 'copy_object') as mock_copy_object,
+    ):
+        harvest_products.harvest_file(source_url, 'prefix')
+
+    assert mock_copy_to_s3.call_count == 1
+    mock_copy_object.assert_not_called()
+
+
+def test_harvest_file_s3_copy_replaces_different_object(s3_bucket):
+    source_url = create_source_object('job_id/product.zip', file_content(0, 4500))
+    s3_bucket.put_object(Key='prefix/product.zip', Body=file_content(1, 4501))
+
+    harvest_products.harvest_file(source_url, 'prefix')
+
+    assert s3_bucket.Object('prefix/product.zip').get()['Body'].read() == file_content(0, 4500)
+
+
+def test_harvest_file_already_harvested(s3_bucket, file_server):
+    s3_bucket.put_object(Key='prefix/product.zip', Body=file_content(0, 4500))
+
+    with patch('harvest_products.PART_SIZE', 1000), patch('harvest_products.upload_part') as mock_upload_part:
+        harvest_products.harvest_file(f'{file_server.url}/4500/product.zip', 'prefix')
+
+    assert file_server.requests == ['bytes=0-999']
+    mock_upload_part.assert_not_called()
+
+
+@responses.activate
+def test_harvest_file_existing_object_access_denied(s3_stubber):
+    responses.add(responses.GET, 'https://foo.com/file.png', body='image_content')
+    s3_stubber.add_client_error(
+        method='head_object',
+        service_error_code='403',
+        http_status_code=403,
+        expected_params={'Bucket': environ['BUCKET_NAME'], 'Key': 'prefix/file.png'},
+    )
     params = {'Bucket': environ['BUCKET_NAME'], 'Key': 'prefix/file.png', 'ContentType': 'image/png', 'Body': ANY}
     s3_stubber.add_response(method='put_object', expected_params=params, service_response={})
+
     response = harvest_products.harvest_file('https://foo.com/file.png', 'prefix')
 
     assert response == f'https://{environ["BUCKET_NAME"]}.s3.amazonaws.com/prefix/file.png'
 
 
 @patch('harvest_products.harvest_file')
-def test_harvest(mock_harvest_file: MagicMock):
+def test_harvest(mock_harvest_file: MagicMock, tables):
     product = {
         'event_id': 'event_id',
         'product_id': 'product_id',
@@ -55,13 +351,63 @@ def test_harvest(mock_harvest_file: MagicMock):
         'product_url': 'https://foo.com/file.png',
     }
 
-    assert mock_harvest_file.mock_calls == [
-        call('BROWSE_IMAGE_URL', 'event_id/product_id'),
-        call('THUMBNAIL_IMAGE_URL', 'event_id/product_id'),
+    assert mock_harvest_file.call_count == 3
+    mock_harvest_file.assert_has_calls(
+        [
+            call('BROWSE_IMAGE_URL', 'event_id/product_id'),
+            call('THUMBNAIL_IMAGE_URL', 'event_id/product_id'),
+            call('PRODUCT_URL', 'event_id/product_id'),
+        ],
+        any_order=True,
+    )
+
+    assert tables.product_table.scan()['Items'][0]['files'] == {
+        'browse_url': 'https://foo.com/file.png',
+        'thumbnail_url': 'https://foo.com/file.png',
+        'product_url': 'https://foo.com/file.png',
+    }
+
+
+def test_harvest_skips_harvested_files(tables):
+    product = {'event_id': 'event_id', 'product_id': 'product_id', 'files': {'browse_url': 'https://foo.com/browse'}}
+
+    class MockJob:
+        files = [{'filename': 'product.zip', 'size': 123, 'url': 'PRODUCT_URL'}]
+        browse_images = ['BROWSE_IMAGE_URL']
+        thumbnail_images = ['THUMBNAIL_IMAGE_URL']
+
+    with patch('harvest_products.harvest_file', return_value='https://foo.com/file') as mock_harvest_file:
+        files = harvest_products.harvest(product, MockJob())
+
+    assert files['browse_url'] == 'https://foo.com/browse'
+    assert sorted(mock_harvest_file.mock_calls) == [
         call('PRODUCT_URL', 'event_id/product_id'),
+        call('THUMBNAIL_IMAGE_URL', 'event_id/product_id'),
     ]
 
 
+def test_harvest_files_concurrently(tables):
+    product = {'event_id': 'event_id', 'product_id': 'product_id'}
+
+    class MockJob:
+        files = [{'filename': 'product.zip', 'size': 123, 'url': 'PRODUCT_URL'}]
+        browse_images = ['BROWSE_IMAGE_URL']
+        thumbnail_images = ['THUMBNAIL_IMAGE_URL']
+
+    all_files_started = Barrier(3, timeout=5)
+
+    def mock_harvest_file(file_url, destination_prefix):
+        all_files_started.wait()
+        return f'https://foo.com/{file_url}'
+
+    with patch('harvest_products.harvest_file', mock_harvest_file):
+        files = harvest_products.harvest(product, MockJob())
+
+    assert files['browse_url'] == 'https://foo.com/BROWSE_IMAGE_URL'
+    assert files['thumbnail_url'] == 'https://foo.com/THUMBNAIL_IMAGE_URL'
+    assert files['product_url'] == 'https://foo.com/PRODUCT_URL'
+
+
 def test_update_product_succeeded(tables):
     product = {
         'event_id': '1',
@@ -129,3 +475,287 @@ def test_update_product_failed(tables):
 
     assert updated_product['status_code'] == 'FAILED'
     assert 'files' not in updated_product
+
+
+def add_hyp3_jobs_responses(jobs, page_size):
+    job_requests = []
+
+    def callback(request):
+        job_requests.append(request.url)
+        params = dict(request.params)
+        offset = int(params.pop('offset', 0))
+        matching_jobs = [
+            job
+            for job in jobs
+            if job['status_code'] == params['status_code'] and job['request_time'] >= params['start']
+        ]
+        body: dict = {'jobs': matching_jobs[offset : offset + page_size]}
+        if offset + page_size < len(matching_jobs):
+            body['next'] = f'{request.url}&offset={offset + page_size}'
+        return 200, {}, json.dumps(body)
+
+    def job_by_id_callback(request):
+        job_requests.append(request.url)
+        job_id = request.url.rpartition('/')[2]
+        return 200, {}, json.dumps(next(job for job in jobs if job['job_id'] == job_id))
+
+    responses.add(responses.GET, AUTH_URL)
+    responses.add_callback(responses.GET, f'{environ["HYP3_URL"]}/jobs', callback=callback)
+    responses.add_callback(
+        responses.GET, re.compile(f'{re.escape(environ["HYP3_URL"])}/jobs/.+'), callback=job_by_id_callback
+    )
+    return job_requests
+
+
+def days_ago(days):
+    return (datetime.now(tz=timezone.utc) - timedelta(days=days)).isoformat(timespec='seconds')
+
+
+@responses.activate
+def test_get_completed_jobs():
+    jobs = [
+        {
+            'job_id': f'job{index}',
+            'job_type': 'RTC_GAMMA',
+            'request_time': days_ago(6 - index),
+            'status_code': status_code,
+            'user_id': 'some_user',
+        }
+        for index, status_code in enumerate(['SUCCEEDED', 'SUCCEEDED', 'SUCCEEDED', 'FAILED', 'RUNNING'], start=1)
+    ]
+    job_requests = add_hyp3_jobs_responses(jobs, page_size=1)
+    hyp3 = HyP3(environ['HYP3_URL'], username=environ['EDL_USERNAME'], password=environ['EDL_PASSWORD'])
+
+    assert harvest_products.get_completed_jobs(hyp3, []) == {}
+    assert len(job_requests) == 0
+
+    products = [
+        {'product_id': job['job_id'], 'processing_date': job['request_time']} for job in [jobs[1], jobs[4], jobs[3]]
+    ]
+    completed_jobs = harvest_products.get_completed_jobs(hyp3, products)
+
+    assert sorted(completed_jobs) == ['job2', 'job3', 'job4']
+    assert completed_jobs['job4'].status_code == 'FAILED'
+    assert len(job_requests) == 3
+
+
+@responses.activate
+def test_get_completed_jobs_old_pending_product():
+    jobs = [
+        {
+            'job_id': f'job{index}',
+            'job_type': 'RTC_GAMMA',
+            'request_time': days_ago(1),
+            'status_code': 'SUCCEEDED',
+            'user_id': 'some_user',
+        }
+        for index in range(20)
+    ]
+    old_job = {
+        'job_id': 'old_job',
+        'job_type': 'RTC_GAMMA',
+        'request_time': days_ago(100),
+        'status_code': 'SUCCEEDED',
+        'user_id': 'some_user',
+    }
+    job_requests = add_hyp3_jobs_responses([old_job, *jobs], page_size=10)
+    hyp3 = HyP3(environ['HYP3_URL'], username=environ['EDL_USERNAME'], password=environ['EDL_PASSWORD'])
+
+    products = [{'product_id': job['job_id'], 'processing_date': job['request_time']} for job in [old_job, jobs[0]]]
+    completed_jobs = harvest_products.get_completed_jobs(hyp3, products)
+
+    assert 'old_job' in completed_jobs
+    assert 'job0' in completed_jobs
+    assert len(job_requests) == 4
+    assert f'{environ["HYP3_URL"]}/jobs/old_job' in job_requests
+
+
+@responses.activate
+def test_lambda_handler(tables):
+    statuses = ['SUCCEEDED'] * 6 + ['FAILED'] * 2 + ['RUNNING'] * 2
+    jobs = [
+        {
+            'job_id': f'job{index}',
+            'job_type': 'RTC_GAMMA',
+            'request_time': days_ago(1),
+            'status_code': status_code,
+            'user_id': 'some_user',
+        }
+        for index, status_code in enumerate(statuses)
+    ]
+    job_requests = add_hyp3_jobs_responses(jobs, page_size=5)
+    for job in jobs:
+        tables.product_table.put_item(
+            Item={
+                'event_id': '1',
+                'product_id': job['job_id'],
+                'granules': [],
+                'status_code': 'PENDING',
+                'processing_date': job['request_time'],
+            }
+        )
+
+    all_products_started = Barrier(2, timeout=5)
+
+    def mock_harvest(product, job):
+        all_products_started.wait()
+        return {'product_url': f'https://foo.com/{product["product_id"]}.zip'}
+
+    with patch('harvest_products.harvest', mock_harvest):
+        harvest_products.lambda_handler(None, None)
+
+    assert len(job_requests) == 3
+
+    updated_products = {item['product_id']: item for item in tables.product_table.scan()['Items']}
+    for job in jobs:
+        product = updated_products[job['job_id']]
+        if job['status_code'] == 'SUCCEEDED':
+            assert product['status_code'] == 'SUCCEEDED'
+            assert product['files'] == {'product_url': f'https://foo.com/{job["job_id"]}.zip'}
+        elif job['status_code'] == 'FAILED':
+            assert product['status_code'] == 'FAILED'
+            assert 'files' not in product
+        else:
+            assert product['status_code'] == 'PENDING'
+            assert 'files' not in product
+
+
+@responses.activate
+def test_lambda_handler_errors(tables, capsys):
+    jobs = [
+        {
+            'job_id': job_id,
+            'job_type': 'RTC_GAMMA',
+            'request_time': days_ago(1),
+            'status_code': 'SUCCEEDED',
+            'user_id': 'some_user',
+        }
+        for job_id in ['foo', 'bar', 'baz']
+    ]
+    add_hyp3_jobs_responses(jobs, page_size=5)
+    for job in jobs:
+        tables.product_table.put_item(
+            Item={
+                'event_id': '1',
+                'product_id': job['job_id'],
+                'granules': [],
+                'status_code': 'PENDING',
+                'processing_date': job['request_time'],
+            }
+        )
+
+    def mock_harvest(product, job):
+        if product['product_id'] != 'bar':
+            raise ValueError(f'bad product {product["product_id"]}')
+        return {'product_url': 'https://foo.com/bar.zip'}
+
+    with patch('harvest_products.harvest', mock_harvest):
+        with pytest.raises(RuntimeError, match=r'Failed to update 2 of 3 products'):
+            harvest_products.lambda_handler(None, None)
+
+    output = capsys.readouterr().out
+    assert "Error updating product foo: ValueError('bad product foo')" in output
+    assert "Error updating product baz: ValueError('bad product baz')" in output
+
+    updated_products = {item['product_id']: item for item in tables.product_table.scan()['Items']}
+    assert updated_products['bar']['status_code'] == 'SUCCEEDED'
+    assert updated_products['foo']['status_code'] == 'PENDING'
+    assert updated_products['baz']['status_code'] == 'PENDING'
+
+
+def test_predict_harvest_seconds():
+    job = Job(
+        job_type='RTC_GAMMA',
+        job_id='foo',
+        request_time=parser.parse('2020-01-01T00:00:00+00:00'),
+        status_code='SUCCEEDED',
+        user_id='some_user',
+        files=[{'filename': 'product.zip', 'size': 2000, 'url': 'PRODUCT_URL'}],
+    )
+    with patch('harvest_products.TRANSFER_THROUGHPUT', 100), patch('harvest_products.PRODUCT_OVERHEAD_SECONDS', 5):
+        assert harvest_products.predict_harvest_seconds(job) == 25
+
+        job.status_code = 'FAILED'
+        assert harvest_products.predict_harvest_seconds(job) == 5
+
+
+def test_order_from_cursor():
+    products = [
+        {'product_id': 'c', 'processing_date': '2020-01-02T00:00:00+00:00'},
+        {'product_id': 'a', 'processing_date': '2020-01-01T00:00:00+00:00'},
+        {'product_id': 'b', 'processing_date': '2020-01-02T00:00:00+00:00'},
+        {'product_id': 'd', 'processing_date': '2020-01-03T00:00:00+00:00'},
+    ]
+
+    def ids(ordered):
+        return [product['product_id'] for product in ordered]
+
+    assert ids(harvest_products.order_from_cursor(products, None)) == ['a', 'b', 'c', 'd']
+    cursor = {'product_id': 'c', 'processing_date': '2020-01-02T00:00:00+00:00'}
+    assert ids(harvest_products.order_from_cursor(products, cursor)) == ['c', 'd', 'a', 'b']
+    cursor = {'product_id': 'gone', 'processing_date': '2020-01-02T12:00:00+00:00'}
+    assert ids(harvest_products.order_from_cursor(products, cursor)) == ['d', 'a', 'b', 'c']
+
+
+@responses.activate
+def test_lambda_handler_time_budget(tables):
+    jobs = [
+        {
+            'job_id': f'job{index}',
+            'job_type': 'RTC_GAMMA',
+            'request_time': days_ago(1),
+            'status_code': 'SUCCEEDED',
+            'user_id': 'some_user',
+            'files': [{'filename': 'product.zip', 'size': 100, 'url': 'PRODUCT_URL', 's3': {}}],
+        }
+        for index in range(5)
+    ]
+    add_hyp3_jobs_responses(jobs, page_size=5)
+    for job in jobs:
+        tables.product_table.put_item(
+            Item={
+                'event_id': '1',
+                'product_id': job['job_id'],
+                'granules': [],
+                'status_code': 'PENDING',
+                'processing_date': job['request_time'],
+            }
+        )
+
+    class MockContext:
+        def __init__(self, remaining_seconds):
+            self.remaining_seconds = remaining_seconds
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining_seconds * 1000
+
+    harvested = []
+    context = MockContext(remaining_seconds=100)
+
+    def mock_harvest(product, job):
+        harvested.append(product['product_id'])
+        context.remaining_seconds -= 20
+        return {}
+
+    with (
+        patch('harvest_products.harvest', mock_harvest),
+        patch('harvest_products.HARVEST_CONCURRENCY', 1),
+        patch('harvest_products.TRANSFER_THROUGHPUT', 10),
+        patch('harvest_products.PRODUCT_OVERHEAD_SECONDS', 10),
+        patch('harvest_products.TIME_BUDGET_MARGIN_SECONDS', 30),
+    ):
+        harvest_products.lambda_handler(None, context)
+        assert harvested == ['job0', 'job1', 'job2']
+        assert tables.state_table.get_item(Key={'state_id': 'harvest_products_cursor'})['Item']['cursor'] == {
+            'product_id': 'job3',
+            'processing_date': jobs[3]['request_time'],
+        }
+
+        harvested.clear()
+        context.remaining_seconds = 900
+        harvest_products.lambda_handler(None, context)
+        assert harvested == ['job3', 'job4']
+        assert tables.state_table.get_item(Key={'state_id': 'harvest_products_cursor'})['Item']['cursor'] is None
+
+    statuses = {item['product_id']: item['status_code'] for item in tables.product_table.scan()['Items']}
+    assert statuses == {job['job_id']: 'SUCCEEDED' for job in jobs}